@@ -1,158 +1,433 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+import ahocorasick
+from scoring import aggregate_scores
 import re
 import os
+import stat
+import contextlib
+import time
+import tempfile
+from pathlib import Path
 
 # --- データ取得 ---
-@st.cache_data(ttl=600)
-def load_data():
+# シートの値（2次元配列）をDataFrameに変換（行末の空セルはAPIが省略するので空文字で補う）
+def values_to_df(rows, header=True):
+    if not rows:
+        return pd.DataFrame()
+    if header:
+        columns = rows[0]
+        return pd.DataFrame([(row + [""] * len(columns))[:len(columns)] for row in rows[1:]], columns=columns)
+    width = max(len(row) for row in rows)
+    return pd.DataFrame([row + [""] * (width - len(row)) for row in rows])
+
+# 認証とスプレッドシートのオープンはプロセス内で1回だけ（データ自体はload_dataでTTL管理）
+@st.cache_resource
+def get_spreadsheet():
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
     if os.path.exists("credentials.json"):
-        creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", scope)
+        client = gspread.service_account(filename="credentials.json", scopes=scope)
     elif "gcp_service_account" in st.secrets and st.secrets["gcp_service_account"].get("private_key"):
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
+        client = gspread.service_account_from_dict(dict(st.secrets["gcp_service_account"]), scopes=scope)
     else:
         st.error("認証情報がありません。Cloudはsecrets.toml、ローカルはcredentials.jsonが必要です。")
         st.stop()
-    client = gspread.authorize(creds)
-    spreadsheet = client.open_by_key("1ISs5mqSRdZfF3NVOt60VFtY8p8HsM0ZkM3sfu3cPzVE")  # ←差し替えて！
+    return client.open_by_key("1ISs5mqSRdZfF3NVOt60VFtY8p8HsM0ZkM3sfu3cPzVE")  # ←差し替えて！
 
-    student_df = pd.DataFrame(spreadsheet.worksheet("スクール生情報").get_all_records())
-    mentor_df = pd.DataFrame(spreadsheet.worksheet("メンター情報").get_all_records())
-    game_df = pd.DataFrame(spreadsheet.worksheet("ゲーム一覧").get_all_values())
+def fetch_sheets(spreadsheet):
+    # 3シートを1回のAPIリクエストでまとめて取得
+    value_ranges = spreadsheet.values_batch_get(["スクール生情報", "メンター情報", "ゲーム一覧"])["valueRanges"]
+    student_rows, mentor_rows, game_rows = (r.get("values", []) for r in value_ranges)
+
+    student_df = values_to_df(student_rows)
+    mentor_df = values_to_df(mentor_rows)
+    game_df = values_to_df(game_rows, header=False)
     return student_df, mentor_df, game_df
 
+# --- ローカルのParquetキャッシュ ---
+# TTL内ならSheets APIを叩かない。TTL切れでもシートの最終更新日時が同じならそのまま使う
+CACHE_DIR = Path(tempfile.gettempdir()) / "sozow-matching-app"
+CACHE_TTL = 600  # 秒（load_dataのttlにも使う）
+CACHE_NAMES = ["student", "mentor", "game"]
+CACHE_REVISION = CACHE_DIR / "revision.txt"  # 取得時のシート最終更新日時（最後に書く）
+
+# 共有の一時ディレクトリ配下なので、本人所有で他ユーザーが触れないディレクトリのときだけ読み書きする
+# （他ユーザーが先に作ったディレクトリの偽キャッシュを読まないため）
+def is_cache_dir_private():
+    try:
+        st_dir = os.lstat(CACHE_DIR)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st_dir.st_mode) and st_dir.st_uid == os.getuid() and st_dir.st_mode & 0o077 == 0
+
+def read_local_cache():
+    if not is_cache_dir_private():
+        return None
+    paths = [CACHE_DIR / f"{name}.parquet" for name in CACHE_NAMES]
+    try:
+        revision = CACHE_REVISION.read_text()
+        student_df, mentor_df, game_df = (pd.read_parquet(p) for p in paths)
+    except (OSError, ValueError):  # キャッシュがない・壊れている場合は取り直す
+        return None
+    game_df.columns = game_df.columns.astype(int)  # Parquetは列名が文字列のみなので戻す
+    return (student_df, mentor_df, game_df), revision
+
+def is_local_cache_fresh():
+    return time.time() - CACHE_REVISION.stat().st_mtime < CACHE_TTL
+
+# 個人情報を含むので本人だけが読み書きできるファイルとして新規作成する
+def open_private(path, mode="wb"):
+    path.unlink(missing_ok=True)
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), mode)
+
+def write_local_cache(frames, revision):
+    # 列名が重複しているなどParquetにできない場合はキャッシュしないだけ
+    try:
+        CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with contextlib.suppress(OSError):
+            CACHE_DIR.chmod(0o700)  # 以前のバージョンが既定の権限で作ったディレクトリを直す
+        if not is_cache_dir_private():
+            return
+        CACHE_REVISION.unlink(missing_ok=True)
+        for name, df in zip(CACHE_NAMES, [frames[0], frames[1], frames[2].rename(columns=str)]):
+            tmp_path = CACHE_DIR / f"{name}.parquet.tmp"
+            with open_private(tmp_path) as f:
+                df.to_parquet(f)
+            os.replace(tmp_path, CACHE_DIR / f"{name}.parquet")
+        with open_private(CACHE_REVISION, "w") as f:
+            f.write(revision)
+    except (OSError, ValueError):
+        pass
+
+@st.cache_data(ttl=CACHE_TTL)
+def load_data():
+    cached = read_local_cache()
+    if cached is not None and is_local_cache_fresh():
+        frames, _ = cached
+    else:
+        spreadsheet = get_spreadsheet()
+        revision = spreadsheet.get_lastUpdateTime()  # Drive APIのメタデータ取得のみ（軽い）
+        if cached is not None and cached[1] == revision:
+            frames, _ = cached
+            with contextlib.suppress(OSError):
+                CACHE_REVISION.touch()  # 更新なし：TTLを延長
+        else:
+            frames = fetch_sheets(spreadsheet)
+            write_local_cache(frames, revision)
+    student_df, mentor_df, game_df = frames
+    return prepare_student_df(student_df), prepare_mentor_df(mentor_df), game_df
+
+# 文字列として取り出した列（列がなければ空文字）
+def text_column(df, col):
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    return df[col].fillna("").astype(str)
+
+# --- スクール生表の前処理（読み込み時に1回だけ） ---
+def prepare_student_df(student_df):
+    # 自由記述3列を連結した趣味テキスト
+    student_df["__student_text"] = (
+        text_column(student_df, "お子さまの得意なこと、好きなことを教えてください")
+        + text_column(student_df, "興味がある分野をお答えください")
+        + text_column(student_df, "お子さまがSOZOWスクールに期待していること、楽しみにしていることなどを教えてください")
+    )
+    return student_df
+
+# --- メンター表の前処理（読み込み時に1回だけ） ---
+def prepare_mentor_df(mentor_df):
+    mentor_df["追加可能人数"] = pd.to_numeric(mentor_df["追加可能人数"], errors="coerce").fillna(0).astype(int)
+
+    # ゲームレベル列（ゲーム_その他以外）は一括で数値化しておく
+    game_cols, _ = game_metadata(mentor_df)
+    mentor_df[game_cols] = mentor_df[game_cols].apply(pd.to_numeric, errors="coerce").fillna(0).astype(np.int8)
+
+    # 1on1可能時間_* 列は "TRUE" かどうかのboolにしておく
+    time_cols = [c for c in mentor_df.columns if c.startswith("1on1可能時間_")]
+    mentor_df[time_cols] = mentor_df[time_cols].apply(lambda c: c.astype(str).str.strip().str.lower().eq("true"))
+
+    # 性別は前後の空白を落としておく（足切り・加点は完全一致で比較）
+    mentor_df["属性_性別"] = text_column(mentor_df, "属性_性別").str.strip()
+
+    # 趣味テキスト（得意なこと＋サポートが得意なこと）
+    mentor_df["__hobby_text"] = (
+        text_column(mentor_df, "得意なこと趣味興味のあること")
+        + " "
+        + text_column(mentor_df, "特にどんなスクール生のサポートが得意か")
+    )
+    return mentor_df
+
 # --- ゲーム正規名マッピング ---
 def get_game_word_map(game_df):
-    word_to_canonical = {}
-    for i, row in game_df.iterrows():
-        canonical = row[0].strip()
-        aliases = [canonical]
-        if len(row) > 1 and row[1]:
-            aliases += [w.strip() for w in row[1].split(",")]
-        for w in aliases:
-            if w:
-                word_to_canonical[w] = canonical
+    # 1列目が正規名、2列目がカンマ区切りの別名。正規名自身も別名に含める
+    if game_df.empty:
+        return {}, []
+    canonicals = text_column(game_df, 0).str.strip()
+    aliases = text_column(game_df, 1)
+    pairs = pd.concat([
+        pd.DataFrame({"canonical": canonicals, "word": canonicals}),
+        pd.DataFrame({"canonical": canonicals, "word": aliases.str.split(",")}).explode("word"),
+    ]).sort_index(kind="stable")  # 行順（同じ行では正規名→別名）で後勝ち
+    pairs["word"] = pairs["word"].str.strip()
+    pairs = pairs[pairs["word"] != ""]
+    word_to_canonical = dict(zip(pairs["word"], pairs["canonical"]))
     game_list_words = list(word_to_canonical.keys())
     return word_to_canonical, game_list_words
 
-# --- 時間帯足切り判定（曜日・時間カラム名設計前提） ---
-def is_time_slot_match(student, mentor):
-    possible_slots = []
-    for col in student.index:
-        if "定期的" in col and "[" in col and "]" in col:
-            value = student[col]
-            if isinstance(value, str) and value.strip():
-                days = [d.strip() for d in value.split(",")]
-                try:
-                    hour = col.split("[")[-1].split("〜")[0].replace("：", ":").strip()
-                    hour = hour.replace(":", "")  # "17:00" → "1700"
-                    for day in days:
-                        if day in ["月", "火", "水", "木", "金", "土", "日"]:
-                            slot = f"1on1可能時間_{day}_{hour}-"
-                            possible_slots.append(slot)
-                except:
-                    continue
-    # メンターの可能時間カラムに1つでも"TRUE"があれば一致とみなす
-    return any(str(mentor.get(slot, "")).strip().lower() == "true" for slot in possible_slots)
-
-# --- マッチングスコア計算 ---
-def calculate_matching_score(student, mentor, game_list_words, word_to_canonical):
+# --- 時間帯候補スロット抽出（曜日・時間カラム名設計前提） ---
+# 例: "定期的に参加可能な時間帯 [17:00〜18:00]" に「月, 水」→ [("月", "1700"), ("水", "1700")]
+SLOT_COLUMN_RE = re.compile(r"定期的.*\[\s*(\d{1,2})[：:](\d{2})\s*[〜~].*\]")
+
+# スクール生表の時間帯カラムと時刻 [(カラム名, "1700"), ...]（カラム構成が変わらない限り再計算しない）
+@st.cache_data(show_spinner=False)
+def get_slot_columns(columns):
+    slot_columns = []
+    for col in columns:
+        m = SLOT_COLUMN_RE.search(col)
+        if m:
+            slot_columns.append((col, m.group(1) + m.group(2)))  # "17:00" → "1700"
+    return slot_columns
+
+# スクール生の回答をスロットのbool列に（メンター側に存在しないスロットは無視する）
+def get_student_slots(student, slot_index):
+    student_slots = np.zeros(len(slot_index), dtype=bool)
+    for col, hour in get_slot_columns(tuple(student.index)):
+        value = student[col]
+        if not isinstance(value, str):
+            continue
+        for day in value.split(","):
+            j = slot_index.get((day.strip(), hour))
+            if j is not None:
+                student_slots[j] = True
+    return student_slots
+
+# --- メンターの可能時間行列（メンター×スロット、bool）と (曜日, 時刻) → 列番号 ---
+# 例: "1on1可能時間_月_1700-" → ("月", "1700")
+AVAILABILITY_COLUMN_RE = re.compile(r"1on1可能時間_([月火水木金土日])_(\d+)-")
+
+def get_availability(mentor_df):
+    slot_index = {}
+    for col in mentor_df.columns:
+        m = AVAILABILITY_COLUMN_RE.fullmatch(col)
+        if m:
+            slot_index[(m.group(1), m.group(2))] = col
+    availability = mentor_df[list(slot_index.values())].to_numpy(bool)  # load_dataでbool化済み
+    return availability, {slot: j for j, slot in enumerate(slot_index)}
+
+# --- ゲーム名のAho-Corasickオートマトン ---
+def build_game_automaton(word_to_canonical):
+    automaton = ahocorasick.Automaton()
+    for g_word, canonical in word_to_canonical.items():
+        automaton.add_word(g_word, (g_word, canonical))
+    automaton.make_automaton()
+    return automaton
+
+# テキスト中に登場するゲーム名 → 正規名
+def find_game_words(automaton, text):
+    if automaton.kind != ahocorasick.AHOCORASICK:  # ゲーム一覧が空
+        return {}
+    return {g_word: canonical for _, (g_word, canonical) in automaton.iter(text)}
+
+# --- ゲームカラムのメタデータ（カラム構成が変わらない限り再計算しない） ---
+@st.cache_data(show_spinner=False, hash_funcs={pd.DataFrame: lambda df: tuple(df.columns)})
+def game_metadata(mentor_df):
+    game_cols = [c for c in mentor_df.columns if c.startswith("ゲーム_") and c != "ゲーム_その他"]
+    game_names = np.array([c.removeprefix("ゲーム_") for c in game_cols])
+    return game_cols, game_names
+
+# --- ゲームレベル行列（メンター×ゲーム、int8） ---
+def get_game_levels(mentor_df):
+    game_cols, game_names = game_metadata(mentor_df)
+    game_levels = mentor_df[game_cols].to_numpy(np.int8)  # load_dataで数値化済み
+    return game_names, game_levels
+
+# --- ゲーム名ごとの対応ゲームカラム {ゲーム名: [列番号, ...]}（カラム名とゲーム名の部分一致、スクール生によらない） ---
+def get_game_word_cols(game_names, word_to_canonical):
+    # 小文字化はゲーム名・カラム名それぞれ1回だけ
+    names_lc = [game_name.lower() for game_name in game_names]
+    game_word_cols = {}
+    for g_word in word_to_canonical:
+        word = g_word.lower()
+        cols = [j for j, name in enumerate(names_lc) if name in word or word in name]
+        if cols:
+            game_word_cols[g_word] = cols
+    return game_word_cols
+
+# --- ゲーム名の集合をuint64のビット列で表す（ゲーム名の番号 = ビット位置、末尾の軸をパック） ---
+def pack_bits(hits):
+    n_blocks = max(1, (hits.shape[-1] + 63) // 64)
+    padded = np.zeros(hits.shape[:-1] + (n_blocks * 64,), dtype=bool)
+    padded[..., :hits.shape[-1]] = hits
+    return np.packbits(padded, axis=-1, bitorder="little").view(np.uint64)
+
+def unpack_bits(bits, n):
+    return np.unpackbits(bits.view(np.uint8), bitorder="little")[:n].astype(bool)
+
+# --- メンターのゲーム_その他（自由記述）に登場するゲーム名のビット列（メンター×ブロック、スクール生によらない） ---
+OTHER_GAMES_SPLIT_RE = re.compile(r"[、,/\s\n]+")
+
+def get_mentor_other_bits(mentor_df, automaton, game_words):
+    # 区切り語ごとにオートマトンで走査（区切りをまたいだ一致は拾わない）
+    hits = np.zeros((len(mentor_df), len(game_words)), dtype=bool)
+    for i, other_games in enumerate(text_column(mentor_df, "ゲーム_その他")):
+        for o in OTHER_GAMES_SPLIT_RE.split(other_games):
+            for g_word in find_game_words(automaton, o):
+                hits[i, game_words.get_loc(g_word)] = True
+    return pack_bits(hits)
+
+# --- スクール生テキストに登場するゲーム（ゲームカラムごと） ---
+# student_words はオートマトンで検出済みの {ゲーム名: 正規名}。検出語（少数）から対応カラムを引くだけ
+def get_student_game_hits(student_words, game_word_cols, n_cols):
+    game_hits = [set() for _ in range(n_cols)]
+    for g_word, canonical in student_words.items():
+        for j in game_word_cols.get(g_word, ()):
+            game_hits[j].add(canonical)
+    in_student = np.array([bool(hits) for hits in game_hits], dtype=bool)
+    return in_student, game_hits
+
+# --- メンター表から必要な列だけをNumPy配列で取り出す（列がなければ空文字） ---
+def mentor_arrays(mentor_df, cols):
+    empty = np.full(len(mentor_df), "", dtype=object)
+    return {col: mentor_df[col].to_numpy() if col in mentor_df.columns else empty for col in cols}
+
+# --- 趣味テキストの特徴量（語彙を作らない特徴量ハッシュ、文字2〜3-gramなので日本語でも分かち書き不要） ---
+HOBBY_VECTORIZER = HashingVectorizer(
+    n_features=2**15, alternate_sign=False, norm=None, analyzer="char_wb", ngram_range=(2, 3)
+)
+
+# --- メンター趣味テキストのTF-IDF行列 ---
+def build_hobby_index(mentor_hobby_texts):
+    if len(mentor_hobby_texts) == 0:  # メンターが0人（score_allは足切りで打ち切るのでtfidfは使われない）
+        return None, sparse.csr_matrix((0, HOBBY_VECTORIZER.n_features))
+    counts = HOBBY_VECTORIZER.transform(mentor_hobby_texts)
+    tfidf = TfidfTransformer().fit(counts)  # IDFはメンター側の文書頻度で固定
+    return tfidf, tfidf.transform(counts).tocsr()  # 各行はL2正規化済み
+
+# --- 趣味テキスト類似度（スクール生だけをTF-IDF化してメンター行列と1回の疎行列積） ---
+def get_hobby_similarities(student_text, tfidf, mentor_matrix):
+    q = tfidf.transform(HOBBY_VECTORIZER.transform([student_text]))
+    if q.nnz == 0:
+        return np.zeros(mentor_matrix.shape[0])
+    return (q @ mentor_matrix.T).toarray().ravel()
+
+# --- メンター表・ゲーム一覧から作る検索用の索引（シートが変わらない限り再構築しない） ---
+# オートマトンや疎行列はpickleで複製せずに使い回したいので cache_resource（読み取り専用で使うこと）
+@st.cache_resource(show_spinner=False, max_entries=1)  # 使うのは最新のシートの索引だけ
+def build_indexes(mentor_df, game_df):
+    word_to_canonical, _ = get_game_word_map(game_df)
+    automaton = build_game_automaton(word_to_canonical)
+    game_words = pd.Index(list(word_to_canonical))  # ゲーム名 → 番号（ビット位置）
+    game_names, game_levels = get_game_levels(mentor_df)
+    availability, slot_index = get_availability(mentor_df)
+    tfidf, mentor_matrix = build_hobby_index(mentor_df["__hobby_text"])
+    return {
+        "automaton": automaton,
+        "game_levels": game_levels,
+        "game_word_cols": get_game_word_cols(game_names, word_to_canonical),
+        "game_words": game_words,
+        "game_word_canonicals": np.array(list(word_to_canonical.values()), dtype=object),
+        "mentor_other_bits": get_mentor_other_bits(mentor_df, automaton, game_words),
+        "availability": availability,
+        "slot_index": slot_index,
+        "tfidf": tfidf,
+        "mentor_matrix": mentor_matrix,
+    }
+
+# --- マッチングスコア計算（全メンター一括） ---
+def score_all(student, mentor_df, indexes):
+    mentor = mentor_arrays(mentor_df, ["追加可能人数", "属性_性別"])
+
     # === 必須足切り ===
-    # (1) 時間帯
-    if not is_time_slot_match(student, mentor):
-        return 0, "時間帯が一致しない"
+    # (1) 時間帯：メンターの可能時間カラムに1つでも"TRUE"があれば一致とみなす
+    # メンター側に存在しないスロットは無視する
+    slot_ok = (indexes["availability"] & get_student_slots(student, indexes["slot_index"])).any(axis=1)
 
     # (2) 担当枠
-    if int(mentor.get("追加可能人数", 0)) < 1:
-        return 0, "担当枠が空いていない"
+    capacity_ok = mentor["追加可能人数"] >= 1
 
     # (3) 性別希望の足切り・加点
-    mentor_gender = mentor.get("属性_性別", "").strip()
+    mentor_gender = mentor["属性_性別"]  # load_dataでstrip済み
     student_gender = student.get("お子さまの性別", "").strip()
     student_gender_pref = student.get("メンターの性別のご希望", "").strip()
-    score = 0
-    reasons = []
-
     if student_gender_pref and student_gender_pref not in ["指定なし", "", None]:
         # 希望があれば一致しなければ除外、一致しても加点はしない
-        if student_gender_pref != mentor_gender:
-            return 0, "性別希望に一致しない"
-        # 一致しても加点なし
-    elif student_gender and student_gender == mentor_gender:
+        gender_ok = mentor_gender == student_gender_pref
+        gender_point = np.zeros(len(mentor_df), dtype=np.int8)
+    else:
         # 性別希望未指定なら「本人性別=メンター性別」で+10点
-        score += 10
-        reasons.append("性別一致（本人と同じ）")
+        gender_ok = np.ones(len(mentor_df), dtype=bool)
+        gender_point = np.where(bool(student_gender) & (mentor_gender == student_gender), 10, 0).astype(np.int8)
 
-    # === ゲームマッチ加点 ===
-    student_text = (
-        str(student.get("お子さまの得意なこと、好きなことを教えてください", ""))
-        + str(student.get("興味がある分野をお答えください", ""))
-        + str(student.get("お子さまがSOZOWスクールに期待していること、楽しみにしていることなどを教えてください", ""))
+    passed = slot_ok & capacity_ok & gender_ok
+    rejected = np.select(
+        [~slot_ok, ~capacity_ok, ~gender_ok],
+        ["時間帯が一致しない", "担当枠が空いていない", "性別希望に一致しない"],
+        default="",
     )
-    matched_games_canonical = set()
-    max_game_point = 0
+    # 以降の加点・理由づくりは足切りを通過したメンターだけを対象にする
+    passed_idx = np.flatnonzero(passed)
+    if len(passed_idx) == 0:
+        return np.zeros(len(mentor_df)), rejected.tolist()
+
+    # === ゲームマッチ加点 ===
+    student_text = student["__student_text"]
+    student_words = find_game_words(indexes["automaton"], student_text)
+    game_levels = indexes["game_levels"]
+    in_student, game_hits = get_student_game_hits(student_words, indexes["game_word_cols"], game_levels.shape[1])
 
     # 個別ゲームカラム（レベル付き）
-    for col in mentor.index:
-        if col.startswith("ゲーム_") and col != "ゲーム_その他":
-            game_name = col.replace("ゲーム_", "")
-            game_value = pd.to_numeric(mentor[col], errors="coerce")
-            if game_value >= 2:
-                for g_word in game_list_words:
-                    if (game_name.lower() in g_word.lower() or g_word.lower() in game_name.lower()) and g_word in student_text:
-                        canonical = word_to_canonical.get(g_word, g_word)
-                        matched_games_canonical.add(canonical)
-                        point = int(game_value) * 5
-                        if point > max_game_point:
-                            max_game_point = point
+    eligible = (game_levels >= 2) & in_student
+    game_point = np.where(eligible, game_levels, 0).max(axis=1, initial=0).astype(int) * 5  # int8のまま最大値をとる
 
     # ゲーム_その他（自由記述）
-    other_games = mentor.get("ゲーム_その他", "")
-    other_words = re.split(r"[、,/\s\n]+", other_games)
-    for g_word in game_list_words:
-        if g_word in student_text and any(g_word in o for o in other_words):
-            canonical = word_to_canonical.get(g_word, g_word)
-            matched_games_canonical.add(canonical)
-            if 15 > max_game_point:
-                max_game_point = 15
-
-    score += max_game_point
-    if max_game_point > 0 and matched_games_canonical:
-        reasons.append(f"ゲームマッチ（{','.join(sorted(matched_games_canonical))}）{max_game_point}点")
+    # その他欄のゲーム名は読み込み時にビット列化済みなので、スクール生のゲーム名とのANDだけ
+    student_word_hits = np.zeros(len(indexes["game_words"]), dtype=bool)
+    student_word_hits[indexes["game_words"].get_indexer(list(student_words))] = True
+    other_bits = indexes["mentor_other_bits"] & pack_bits(student_word_hits)
+    other_ok = other_bits.any(axis=1)
+    game_point = np.maximum(game_point, np.where(other_ok, 15, 0))
 
     # === 趣味マッチ（テキスト類似度×30点） ===
-    mentor_hobby_text = (
-        str(mentor.get("得意なこと趣味興味のあること", ""))
-        + " " + str(mentor.get("特にどんなスクール生のサポートが得意か", ""))
-    )
-    def calculate_text_similarity(text1, text2):
-        if not text1 or not text2:
-            return 0.0
-        vectorizer = CountVectorizer().fit_transform([str(text1), str(text2)])
-        vectors = vectorizer.toarray()
-        return cosine_similarity([vectors[0]], [vectors[1]])[0][0]
-
-    similarity_score = calculate_text_similarity(student_text, mentor_hobby_text)
-    hobby_point = similarity_score * 30
-    score += hobby_point
-    if hobby_point > 0:
-        reasons.append(f"趣味・興味マッチ {hobby_point:.1f}点")
-
-    if not reasons:
-        reasons.append("最低条件は満たしています")
-    return score, "＋".join(reasons)
+    hobby_point = np.zeros(len(mentor_df))
+    hobby_point[passed_idx] = get_hobby_similarities(
+        student_text, indexes["tfidf"], indexes["mentor_matrix"][passed_idx]
+    ) * 30
+
+    scores = aggregate_scores(slot_ok, capacity_ok, gender_ok, gender_point, game_point, hobby_point)
+
+    # === おすすめ理由 ===
+    reasons = rejected.tolist()
+    for i in passed_idx:
+        parts = []
+        if gender_point[i] > 0:
+            parts.append("性別一致（本人と同じ）")
+        if game_point[i] > 0:
+            other_words = unpack_bits(other_bits[i], len(indexes["game_words"]))
+            matched_games_canonical = set(indexes["game_word_canonicals"][other_words])
+            for j in np.flatnonzero(eligible[i]):
+                matched_games_canonical.update(game_hits[j])
+            parts.append(f"ゲームマッチ（{','.join(sorted(matched_games_canonical))}）{game_point[i]}点")
+        if hobby_point[i] > 0:
+            parts.append(f"趣味・興味マッチ {hobby_point[i]:.1f}点")
+        reasons[i] = "＋".join(parts) if parts else "最低条件は満たしています"
+    return scores, reasons
+
+# --- 上位k人（スコア>0）のインデックスをスコア降順で（全件ソートせず部分選択） ---
+def top_k_indices(scores, k):
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
 
 # --- Streamlit UI ---
 st.set_page_config(layout="wide")
 st.title("SOZOW メンターマッチングアプリ")
 
 student_df, mentor_df, game_df = load_data()
-word_to_canonical, game_list_words = get_game_word_map(game_df)
+indexes = build_indexes(mentor_df, game_df)
 
 if len(student_df) == 0:
     st.warning("スクール生情報が空です。")
@@ -163,25 +438,19 @@ selected_id = st.selectbox("スクール生IDを選択", student_ids)
 
 if selected_id:
     selected_student = student_df[student_df["スクールID"] == selected_id].iloc[0]
-    mentor_df["追加可能人数"] = pd.to_numeric(mentor_df["追加可能人数"], errors="coerce").fillna(0).astype(int)
-    scores = []
-    reasons = []
-    for _, row in mentor_df.iterrows():
-        score, reason = calculate_matching_score(selected_student, row, game_list_words, word_to_canonical)
-        scores.append(score)
-        reasons.append(reason)
-
-    mentor_df["マッチングスコア"] = scores
-    mentor_df["おすすめ理由"] = reasons
+    scores, reasons = score_all(selected_student, mentor_df, indexes)
 
-    matched = mentor_df[mentor_df["マッチングスコア"] > 0].sort_values("マッチングスコア", ascending=False)
+    top = top_k_indices(scores, 10)
+    matched = mentor_df.iloc[top].assign(
+        マッチングスコア=scores[top], おすすめ理由=[reasons[i] for i in top]
+    )
 
     if matched.empty:
         st.warning("条件に一致するメンターがいません。")
     else:
         st.markdown("### 🎯 おすすめメンター一覧（上位10人）")
         st.dataframe(
-            matched[["ニックネーム", "マッチングスコア", "追加可能人数", "属性_性別", "おすすめ理由"]].head(10)
+            matched[["ニックネーム", "マッチングスコア", "追加可能人数", "属性_性別", "おすすめ理由"]]
         )
 else:
     st.info("スクール生を選択してください。")
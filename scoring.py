@@ -0,0 +1,17 @@
+import numpy as np
+from numba import njit
+
+# Streamlitはウィジェット操作のたびにapp.pyを実行し直すため、Numbaのカーネルはこのモジュールに置く
+# （importしたモジュールはsys.modulesに残るので、コンパイル済みのディスパッチャを再実行をまたいで使い回せる）
+
+# --- スコア集計（足切りを通過したメンターだけ加点を合計、Numbaで1パス） ---
+# Streamlitはセッションごとに別スレッドでスクリプトを実行するため parallel=True は使わない
+# （Numbaのデフォルトのスレッド層は複数スレッドからの同時呼び出しに対応していない）
+@njit(fastmath=True, cache=True)
+def aggregate_scores(slot_ok, capacity_ok, gender_ok, gender_point, game_point, hobby_point):
+    n = slot_ok.shape[0]
+    out = np.zeros(n, np.float64)
+    for i in range(n):
+        if slot_ok[i] and capacity_ok[i] and gender_ok[i]:
+            out[i] = gender_point[i] + game_point[i] + hobby_point[i]
+    return out